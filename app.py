@@ -4,18 +4,23 @@ Sample application for Prometheus metrics demonstration.
 Exports RED (Rate, Errors, Duration) and USE (Utilization, Saturation, Errors) metrics.
 """
 
+import asyncio
+import glob
+import os
 import time
 import random
-import threading
-from flask import Flask, jsonify, request
-from prometheus_client import (
-    Counter, Histogram, Gauge, Summary, generate_latest, CONTENT_TYPE_LATEST,
-    REGISTRY
-)
-from prometheus_client.core import CollectorRegistry
+import sys
+import zlib
+from functools import lru_cache
+from quart import Quart, Response, jsonify, request
+from prometheus_client import Counter, Histogram, Gauge, REGISTRY, multiprocess
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.openmetrics import exposition as openmetrics
+from prometheus_client.core import CollectorRegistry, GaugeMetricFamily
+from prometheus_client.registry import Collector
 import logging
 
-app = Flask(__name__)
+app = Quart(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -32,14 +37,7 @@ http_request_duration_seconds = Histogram(
     'http_request_duration_seconds',
     'HTTP request duration in seconds',
     ['method', 'endpoint'],
-    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
-)
-
-# Request duration summary (alternative to histogram)
-http_request_duration_summary = Summary(
-    'http_request_duration_summary_seconds',
-    'HTTP request duration summary',
-    ['method', 'endpoint']
+    buckets=[0.01, 0.05, 0.25, 1.0, 5.0]
 )
 
 # Error counter
@@ -50,53 +48,84 @@ http_errors_total = Counter(
 )
 
 # USE Metrics (Utilization, Saturation, Errors)
-# CPU utilization simulation
-cpu_utilization_percent = Gauge(
-    'cpu_utilization_percent',
-    'CPU utilization percentage',
-    ['server', 'region']
-)
+# Simulated resource metrics, regenerated on each scrape rather than on a timer
+
+
+class ResourceMetricsCollector(Collector):
+    """Collector that draws fresh simulated resource values whenever it is scraped"""
+
+    def __init__(self):
+        servers = ['web-1', 'web-2', 'api-1']
+        regions = ['us-east', 'us-west', 'eu-central']
+        self._resources = [[server, region] for server in servers for region in regions]
+
+    def collect(self):
+        # CPU utilization (0-100%)
+        cpu_utilization_percent = GaugeMetricFamily(
+            'cpu_utilization_percent',
+            'CPU utilization percentage',
+            labels=['server', 'region']
+        )
+        for labels in self._resources:
+            cpu_utilization_percent.add_metric(labels, random.uniform(20, 95))
+        yield cpu_utilization_percent
+        
+        # Memory utilization (100MB - 8GB)
+        memory_utilization_bytes = GaugeMetricFamily(
+            'memory_utilization_bytes',
+            'Memory utilization in bytes',
+            labels=['server', 'region']
+        )
+        for labels in self._resources:
+            memory_utilization_bytes.add_metric(labels, random.uniform(100_000_000, 8_000_000_000))
+        yield memory_utilization_bytes
+        
+        # Active connections (saturation metric, 0-1000)
+        active_connections = GaugeMetricFamily(
+            'active_connections',
+            'Number of active connections',
+            labels=['server', 'region']
+        )
+        for labels in self._resources:
+            active_connections.add_metric(labels, random.randint(0, 1000))
+        yield active_connections
 
-# Memory utilization
-memory_utilization_bytes = Gauge(
-    'memory_utilization_bytes',
-    'Memory utilization in bytes',
-    ['server', 'region']
-)
 
-# Active connections (saturation metric)
-active_connections = Gauge(
-    'active_connections',
-    'Number of active connections',
-    ['server', 'region']
-)
-
-# Queue depth (saturation)
-queue_depth = Gauge(
-    'queue_depth',
-    'Queue depth',
-    ['queue_name', 'priority']
-)
+resource_metrics_collector = ResourceMetricsCollector()
+REGISTRY.register(resource_metrics_collector)
 
 # Special metrics for PromQL examples
-# Timestamp gauge - last time something happened
-last_order_timestamp = Gauge(
-    'last_order_timestamp_seconds',
-    'Unix timestamp of the last order',
-    ['order_type', 'region']
-)
+# Timestamp gauges - last time something happened. Only registered when
+# PROMQL_EXAMPLES is set, so deployments that don't query them skip the series
+PROMQL_EXAMPLES = bool(os.getenv('PROMQL_EXAMPLES'))
+
+if PROMQL_EXAMPLES:
+    last_order_timestamp = Gauge(
+        'last_order_timestamp_seconds',
+        'Unix timestamp of the last order',
+        ['order_type', 'region'],
+        multiprocess_mode='max'
+    )
+
+    last_user_login_timestamp = Gauge(
+        'last_user_login_timestamp_seconds',
+        'Unix timestamp of the last user login',
+        ['user_tier'],
+        multiprocess_mode='max'
+    )
 
-last_user_login_timestamp = Gauge(
-    'last_user_login_timestamp_seconds',
-    'Unix timestamp of the last user login',
-    ['user_tier']
+# Metrics with multiple label categories for grouping examples
+# Order value is split by dimension so series add up rather than multiply
+order_value_by_category = Counter(
+    'order_value_by_category_total',
+    'Total order value by product category',
+    ['product_category', 'status']
 )
 
-# Metrics with multiple label categories for grouping examples
-order_value = Counter(
-    'order_value_total',
-    'Total order value',
-    ['product_category', 'payment_method', 'region', 'status']
+order_value_by_payment = Counter(
+    'order_value_by_payment_total',
+    'Total order value by payment method',
+    ['payment_method', 'status']
 )
 
 # Metrics that can have missing data (for fill examples)
@@ -119,70 +148,102 @@ products_viewed_total = Counter(
     ['category', 'region']
 )
 
-# Simulate background resource metrics
-def update_resource_metrics():
-    """Background thread to simulate resource metrics"""
-    servers = ['web-1', 'web-2', 'api-1']
-    regions = ['us-east', 'us-west', 'eu-central']
-    
-    while True:
-        for server in servers:
-            for region in regions:
-                # CPU utilization (0-100%)
-                cpu_utilization_percent.labels(
-                    server=server, region=region
-                ).set(random.uniform(20, 95))
-                
-                # Memory utilization (100MB - 8GB)
-                memory_utilization_bytes.labels(
-                    server=server, region=region
-                ).set(random.uniform(100_000_000, 8_000_000_000))
-                
-                # Active connections (0-1000)
-                active_connections.labels(
-                    server=server, region=region
-                ).set(random.randint(0, 1000))
-        
-        # Queue depth
-        queues = ['order-queue', 'notification-queue', 'payment-queue']
-        priorities = ['high', 'medium', 'low']
-        for queue in queues:
-            for priority in priorities:
-                queue_depth.labels(
-                    queue_name=queue, priority=priority
-                ).set(random.randint(0, 500))
-        
-        time.sleep(5)  # Update every 5 seconds
+# Bound children for fixed label sets, so handlers skip labels() per request
+_DUR_PRODUCTS = http_request_duration_seconds.labels('GET', '/products')
+_DUR_ORDERS = http_request_duration_seconds.labels('POST', '/orders')
+_DUR_LOGIN = http_request_duration_seconds.labels('POST', '/users/login')
+_DUR_SLOW = http_request_duration_seconds.labels('GET', '/slow')
+_DUR_ERROR = http_request_duration_seconds.labels('GET', '/error')
+
+_REQ_PRODUCTS_200 = http_requests_total.labels('GET', '/products', '200')
+_REQ_ORDERS_201 = http_requests_total.labels('POST', '/orders', '201')
+_REQ_ORDERS_400 = http_requests_total.labels('POST', '/orders', '400')
+_REQ_LOGIN_200 = http_requests_total.labels('POST', '/users/login', '200')
+_REQ_SLOW_200 = http_requests_total.labels('GET', '/slow', '200')
+_REQ_ERROR_500 = http_requests_total.labels('GET', '/error', '500')
+
+_ERR_ORDERS_VALIDATION = http_errors_total.labels('POST', '/orders', 'validation_error')
+
+# Children for dynamic label values, memoized by their positional label values
+_products_viewed = lru_cache(maxsize=1024)(products_viewed_total.labels)
+_orders = lru_cache(maxsize=1024)(orders_total.labels)
+_order_value_by_category = lru_cache(maxsize=512)(order_value_by_category.labels)
+_order_value_by_payment = lru_cache(maxsize=512)(order_value_by_payment.labels)
+_http_errors = lru_cache(maxsize=512)(http_errors_total.labels)
+# Also memoized rather than bound up front, so a version's series stays absent
+# until it is first called (for fill examples)
+_api_calls = lru_cache(maxsize=1024)(api_calls_total.labels)
+if PROMQL_EXAMPLES:
+    _last_order = lru_cache(maxsize=512)(last_order_timestamp.labels)
+    _last_user_login = lru_cache(maxsize=512)(last_user_login_timestamp.labels)
+
+# Simulated label values, picked by index into these tuples
+_VIEWED_CATEGORIES = ('electronics', 'clothing', 'books', 'food')
+_ORDER_TYPES = ('standard', 'express', 'premium')
+_ORDER_CATEGORIES = ('electronics', 'clothing', 'books')
+_PAYMENT_METHODS = ('credit_card', 'paypal', 'bank_transfer')
+_ORDER_STATUSES = ('pending', 'processing', 'completed')
+_USER_TIERS = ('free', 'premium', 'enterprise')
+_ERROR_TYPES = ('timeout', 'database_error', 'validation_error')
+_random = random.random
+
+perf_counter = time.perf_counter
+
+# X-Region is client-controlled, so anything outside this set is reported as
+# 'other' to keep region-labelled series bounded
+_ALLOWED_REGIONS = frozenset(['us-east', 'us-west', 'eu-central', 'ap-south', 'unknown'])
+
+
+def _region():
+    """Region label for the current request"""
+    region = request.headers.get('X-Region', 'unknown')
+    return region if region in _ALLOWED_REGIONS else 'other'
 
-# Start background thread
-resource_thread = threading.Thread(target=update_resource_metrics, daemon=True)
-resource_thread.start()
+
+class _TimeRequest:
+    """Times a request block, observing its duration and counting its status on exit"""
+    __slots__ = ('hist', 'req', 'start')
+
+    def __init__(self, hist, req):
+        self.hist = hist
+        self.req = req
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            return
+        self.hist.observe(perf_counter() - self.start)
+        self.req.inc()
+
+
+# Bodies of the fixed JSON responses, serialized once
+_INDEX_BODY = b'{"service":"sample-app","status":"healthy"}'
+_V1_BODY = b'{"data":"v1 response"}'
+_V2_BODY = b'{"data":"v2 response"}'
+_V3_BODY = b'{"data":"v3 response"}'
 
 
 @app.route('/')
-def index():
+async def index():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'sample-app'})
+    return Response(_INDEX_BODY, content_type='application/json')
 
 
 @app.route('/products')
-def get_products():
+async def get_products():
     """Get products - simulates variable latency"""
-    start_time = time.time()
-    
-    # Simulate processing time
-    delay = random.uniform(0.01, 0.5)
-    time.sleep(delay)
-    
-    category = random.choice(['electronics', 'clothing', 'books', 'food'])
-    region = request.headers.get('X-Region', 'unknown')
-    
-    products_viewed_total.labels(category=category, region=region).inc()
-    
-    duration = time.time() - start_time
-    http_request_duration_seconds.labels(method='GET', endpoint='/products').observe(duration)
-    http_request_duration_summary.labels(method='GET', endpoint='/products').observe(duration)
-    http_requests_total.labels(method='GET', endpoint='/products', status='200').inc()
+    with _TimeRequest(_DUR_PRODUCTS, _REQ_PRODUCTS_200):
+        # Simulate processing time
+        delay = random.uniform(0.01, 0.5)
+        await asyncio.sleep(delay)
+        
+        category = _VIEWED_CATEGORIES[int(_random() * len(_VIEWED_CATEGORIES))]
+        region = _region()
+        
+        _products_viewed(category, region).inc()
     
     return jsonify({
         'products': [
@@ -193,45 +254,35 @@ def get_products():
 
 
 @app.route('/orders', methods=['POST'])
-def create_order():
+async def create_order():
     """Create order - simulates order processing"""
-    start_time = time.time()
-    
-    # Simulate processing time
-    delay = random.uniform(0.05, 1.0)
-    time.sleep(delay)
-    
-    # Randomly fail some orders (5% error rate)
-    if random.random() < 0.05:
-        duration = time.time() - start_time
-        http_request_duration_seconds.labels(method='POST', endpoint='/orders').observe(duration)
-        http_errors_total.labels(method='POST', endpoint='/orders', error_type='validation_error').inc()
-        http_requests_total.labels(method='POST', endpoint='/orders', status='400').inc()
-        return jsonify({'error': 'Validation failed'}), 400
-    
-    # Simulate order data
-    order_type = random.choice(['standard', 'express', 'premium'])
-    region = request.headers.get('X-Region', 'unknown')
-    product_category = random.choice(['electronics', 'clothing', 'books'])
-    payment_method = random.choice(['credit_card', 'paypal', 'bank_transfer'])
-    status = random.choice(['pending', 'processing', 'completed'])
-    
-    # Update timestamp gauge
-    last_order_timestamp.labels(order_type=order_type, region=region).set(time.time())
-    
-    # Update counters
-    orders_total.labels(status=status, region=region).inc()
-    order_value.labels(
-        product_category=product_category,
-        payment_method=payment_method,
-        region=region,
-        status=status
-    ).inc(random.uniform(10, 1000))
-    
-    duration = time.time() - start_time
-    http_request_duration_seconds.labels(method='POST', endpoint='/orders').observe(duration)
-    http_request_duration_summary.labels(method='POST', endpoint='/orders').observe(duration)
-    http_requests_total.labels(method='POST', endpoint='/orders', status='201').inc()
+    with _TimeRequest(_DUR_ORDERS, _REQ_ORDERS_201) as timer:
+        # Simulate processing time
+        delay = random.uniform(0.05, 1.0)
+        await asyncio.sleep(delay)
+        
+        # Randomly fail some orders (5% error rate)
+        if _random() < 0.05:
+            timer.req = _REQ_ORDERS_400
+            _ERR_ORDERS_VALIDATION.inc()
+            return jsonify({'error': 'Validation failed'}), 400
+        
+        # Simulate order data
+        order_type = _ORDER_TYPES[int(_random() * len(_ORDER_TYPES))]
+        region = _region()
+        product_category = _ORDER_CATEGORIES[int(_random() * len(_ORDER_CATEGORIES))]
+        payment_method = _PAYMENT_METHODS[int(_random() * len(_PAYMENT_METHODS))]
+        status = _ORDER_STATUSES[int(_random() * len(_ORDER_STATUSES))]
+        
+        # Update timestamp gauge (only exported with PROMQL_EXAMPLES set)
+        if PROMQL_EXAMPLES:
+            _last_order(order_type, region).set(time.time())
+        
+        # Update counters
+        _orders(status, region).inc()
+        value = random.uniform(10, 1000)
+        _order_value_by_category(product_category, status).inc(value)
+        _order_value_by_payment(payment_method, status).inc(value)
     
     return jsonify({
         'order_id': random.randint(1000, 9999),
@@ -241,83 +292,146 @@ def create_order():
 
 
 @app.route('/users/<int:user_id>/login', methods=['POST'])
-def user_login(user_id):
+async def user_login(user_id):
     """User login - updates timestamp gauge"""
-    start_time = time.time()
-    
-    delay = random.uniform(0.02, 0.3)
-    time.sleep(delay)
-    
-    user_tier = random.choice(['free', 'premium', 'enterprise'])
-    
-    # Update timestamp gauge for last login
-    last_user_login_timestamp.labels(user_tier=user_tier).set(time.time())
-    
-    duration = time.time() - start_time
-    http_request_duration_seconds.labels(method='POST', endpoint='/users/login').observe(duration)
-    http_requests_total.labels(method='POST', endpoint='/users/login', status='200').inc()
+    with _TimeRequest(_DUR_LOGIN, _REQ_LOGIN_200):
+        delay = random.uniform(0.02, 0.3)
+        await asyncio.sleep(delay)
+        
+        user_tier = _USER_TIERS[int(_random() * len(_USER_TIERS))]
+        
+        # Update timestamp gauge for last login (only exported with PROMQL_EXAMPLES set)
+        if PROMQL_EXAMPLES:
+            _last_user_login(user_tier).set(time.time())
     
     return jsonify({'user_id': user_id, 'tier': user_tier, 'logged_in': True})
 
 
 @app.route('/api/v1/data')
-def api_v1_data():
+async def api_v1_data():
     """API v1 endpoint - for fill missing data examples"""
-    api_calls_total.labels(api_version='v1', endpoint='/data').inc()
-    return jsonify({'data': 'v1 response'})
+    _api_calls('v1', '/data').inc()
+    return Response(_V1_BODY, content_type='application/json')
 
 
 @app.route('/api/v2/data')
-def api_v2_data():
+async def api_v2_data():
     """API v2 endpoint - for fill missing data examples"""
-    api_calls_total.labels(api_version='v2', endpoint='/data').inc()
-    return jsonify({'data': 'v2 response'})
+    _api_calls('v2', '/data').inc()
+    return Response(_V2_BODY, content_type='application/json')
 
 
 @app.route('/api/v3/data')
-def api_v3_data():
+async def api_v3_data():
     """API v3 endpoint - may not be called (for fill examples)"""
-    api_calls_total.labels(api_version='v3', endpoint='/data').inc()
-    return jsonify({'data': 'v3 response'})
+    _api_calls('v3', '/data').inc()
+    return Response(_V3_BODY, content_type='application/json')
 
 
 @app.route('/slow')
-def slow_endpoint():
+async def slow_endpoint():
     """Slow endpoint - for duration analysis"""
-    start_time = time.time()
-    
-    # Simulate slow processing
-    delay = random.uniform(1.0, 3.0)
-    time.sleep(delay)
-    
-    duration = time.time() - start_time
-    http_request_duration_seconds.labels(method='GET', endpoint='/slow').observe(duration)
-    http_requests_total.labels(method='GET', endpoint='/slow', status='200').inc()
+    with _TimeRequest(_DUR_SLOW, _REQ_SLOW_200):
+        # Simulate slow processing
+        delay = random.uniform(1.0, 3.0)
+        await asyncio.sleep(delay)
     
     return jsonify({'message': 'Slow response completed'})
 
 
 @app.route('/error')
-def error_endpoint():
+async def error_endpoint():
     """Error endpoint - for error rate analysis"""
-    start_time = time.time()
-    
-    error_type = random.choice(['timeout', 'database_error', 'validation_error'])
-    http_errors_total.labels(method='GET', endpoint='/error', error_type=error_type).inc()
-    
-    duration = time.time() - start_time
-    http_request_duration_seconds.labels(method='GET', endpoint='/error').observe(duration)
-    http_requests_total.labels(method='GET', endpoint='/error', status='500').inc()
+    with _TimeRequest(_DUR_ERROR, _REQ_ERROR_500):
+        error_type = _ERROR_TYPES[int(_random() * len(_ERROR_TYPES))]
+        _http_errors('GET', '/error', error_type).inc()
     
     return jsonify({'error': error_type}), 500
 
 
+class _SingleFamily:
+    """Registry stand-in exposing one metric family to an exposition encoder"""
+    __slots__ = ('family',)
+
+    def __init__(self, family):
+        self.family = family
+
+    def collect(self):
+        return (self.family,)
+
+
+# Terminator the OpenMetrics encoder appends after the last family
+_OPENMETRICS_EOF = b'# EOF\n'
+
+
+# With PROMETHEUS_MULTIPROC_DIR set, each worker writes its samples to mmap
+# files there and scrapes aggregate across all workers
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+
+def _scrape_registry():
+    """Registry to expose for this scrape"""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(resource_metrics_collector)
+    return registry
+
+
+async def _iter_metrics(encoder):
+    """Yield the registry's exposition one metric family at a time"""
+    openmetrics_format = encoder is openmetrics.generate_latest
+    for family in _scrape_registry().collect():
+        data = encoder(_SingleFamily(family))
+        yield data[:-len(_OPENMETRICS_EOF)] if openmetrics_format else data
+    if openmetrics_format:
+        yield _OPENMETRICS_EOF
+
+
+# Pristine gzip-format compressor (wbits=31), copied for each scrape
+_GZIP_COMPRESSOR = zlib.compressobj(1, zlib.DEFLATED, 31)
+
+
+async def _gzip_chunks(chunks):
+    """Compress a stream of chunks into a single gzip stream"""
+    compressor = _GZIP_COMPRESSOR.copy()
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 @app.route('/metrics')
-def metrics():
-    """Prometheus metrics endpoint"""
-    return generate_latest(REGISTRY), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+async def metrics():
+    """Prometheus metrics endpoint, in OpenMetrics format when the scraper accepts it"""
+    encoder, content_type = choose_encoder(request.headers.get('Accept', ''))
+    body = _iter_metrics(encoder)
+    gzipped = request.accept_encodings['gzip'] > 0
+    if gzipped:
+        body = _gzip_chunks(body)
+    response = Response(body, content_type=content_type)
+    response.vary.add('Accept-Encoding')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    # Replace this process with Uvicorn so `python app.py` and the container
+    # run the same server. Without PROMETHEUS_MULTIPROC_DIR each worker keeps
+    # its own registry, so keep WEB_CONCURRENCY at 1 in that case.
+    if MULTIPROC_DIR:
+        # Drop samples left over from a previous run
+        for path in glob.glob(os.path.join(MULTIPROC_DIR, '*.db')):
+            os.remove(path)
+    os.execv(sys.executable, [
+        sys.executable, '-m', 'uvicorn', 'app:app',
+        '--app-dir', os.path.dirname(os.path.abspath(__file__)),
+        '--host', '0.0.0.0',
+        '--port', '8000',
+        '--workers', os.getenv('WEB_CONCURRENCY', '1'),
+        '--loop', 'uvloop',
+    ])
 
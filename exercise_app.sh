@@ -43,7 +43,7 @@ while true; do
         make_request "GET" "/products" "$region"
     done
     
-    # Orders endpoint - generates orders_total, order_value_total, last_order_timestamp
+    # Orders endpoint - generates orders_total, order_value_by_*_total, last_order_timestamp
     for i in {1..10}; do
         region=${REGIONS[$RANDOM % ${#REGIONS[@]}]}
         make_request "POST" "/orders" "$region"
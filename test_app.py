@@ -0,0 +1,59 @@
+import asyncio
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Enum, Gauge, Histogram, Info, generate_latest
+)
+from prometheus_client.core import GaugeHistogramMetricFamily, Metric
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.openmetrics import exposition as openmetrics
+
+import app
+
+
+class _FixedCollector:
+    """Families the stock metric classes don't produce"""
+
+    def collect(self):
+        gauge_histogram = GaugeHistogramMetricFamily(
+            'queue_wait', 'Queue wait', buckets=[('1.0', 2), ('+Inf', 3)], gsum_value=4
+        )
+        yield gauge_histogram
+        untyped = Metric('legacy', 'Legacy value', 'unknown')
+        untyped.add_sample('legacy', {'zone': 'a'}, 1.5, timestamp=12.5)
+        yield untyped
+
+
+def _registry():
+    registry = CollectorRegistry()
+    requests = Counter('requests', 'Requests', ['method', 'path'], registry=registry)
+    requests.labels('GET', '/products').inc()
+    requests.labels('GET', 'quote " back\\slash \n newline').inc(2)
+    Counter('escaped_help', 'Help with \\ and\nnewline', registry=registry).inc()
+    Histogram('latency_seconds', 'Latency', ['path'], buckets=[0.1, 1.0],
+              registry=registry).labels('/slow').observe(0.5)
+    Gauge('temperature', 'Temperature', registry=registry).set(-1.25)
+    Info('build', 'Build info', registry=registry).info({'version': '1.0'})
+    Enum('state', 'State', states=['up', 'down'], registry=registry)
+    registry.register(_FixedCollector())
+    return registry
+
+
+async def _collect(encoder):
+    return b''.join([chunk async for chunk in app._iter_metrics(encoder)])
+
+
+def test_text_exposition_matches_generate_latest(monkeypatch):
+    registry = _registry()
+    monkeypatch.setattr(app, '_scrape_registry', lambda: registry)
+    text_encoder, _ = choose_encoder('')
+
+    assert asyncio.run(_collect(text_encoder)) == generate_latest(registry)
+
+
+def test_openmetrics_exposition_matches_generate_latest(monkeypatch):
+    registry = _registry()
+    monkeypatch.setattr(app, '_scrape_registry', lambda: registry)
+    openmetrics_encoder, _ = choose_encoder('application/openmetrics-text; version=1.0.0')
+
+    assert openmetrics_encoder is openmetrics.generate_latest
+    assert asyncio.run(_collect(openmetrics_encoder)) == openmetrics.generate_latest(registry)